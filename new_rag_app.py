@@ -1,30 +1,256 @@
 import streamlit as st
 import requests
+import orjson
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from anthropic import Anthropic
 import time
-from typing import List, Dict, Optional
-from urllib.parse import urlparse
+import os
+from diskcache import Cache
+import hashlib
+import heapq
+import itertools
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Hashable, Iterator, List, Dict, Optional, Tuple, Union
+
+# Fixed instructions sent ahead of the retrieved context so Anthropic can cache them as a prompt prefix.
+STATIC_INSTRUCTIONS = """These are very important instructions: You are "Ragie AI", a professional but friendly AI chatbot assisting the user. Your task is to answer the user based on the information provided in the context that follows these instructions. Answer informally, directly, and concisely, including all relevant details. Use Markdown for formatting (e.g., **bold**, *italic*, lists, etc.) and $$ for LaTeX where appropriate. Organize your answer into sections if needed. Do not include raw IDs or sensitive information.
+
+If the context is missing or insufficient, please indicate that the available information might be incomplete."""
+# The cache_control marker is inactive today: this prefix is far below Anthropic's 1024-token
+# minimum for a cacheable prompt on Sonnet models, and the pinned model may not support
+# prompt caching at all. It only takes effect once the static instructions grow past that size.
+STATIC_INSTRUCTIONS_BLOCK = {"type": "text", "text": STATIC_INSTRUCTIONS, "cache_control": {"type": "ephemeral"}}
+CONTEXT_HEADER = "Here is the context available for you:\n"
+# Closes the instructions after the retrieved context, so untrusted document and web text
+# stays inside the instruction boundary as it did before the static prefix was split out.
+CONTEXT_FOOTER = "\n\nEND SYSTEM INSTRUCTIONS"
+
+ANTHROPIC_MODEL = "claude-3-sonnet-20240229"
+MAX_RESPONSE_TOKENS = 1024
+
+@st.cache_resource(show_spinner=False)
+def get_response_disk_cache() -> Cache:
+    """
+    Open the on-disk response cache that persists across Streamlit reruns and restarts.
+    It lives in a private per-user directory, overridable with RAG_CACHE_DIR.
+    """
+    directory = os.environ.get("RAG_CACHE_DIR") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+        "rag-as-service"
+    )
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return Cache(directory, size_limit=int(2e9))
+
+def _normalize_query(query: str) -> str:
+    """
+    Collapse whitespace and case so trivial query variants share a cache key.
+    """
+    return re.sub(r"\s+", " ", query.strip().lower())
+
+def _estimate_tokens(text: str) -> int:
+    """
+    Rough token count at ~4 characters per token; exact counting would need an API call.
+    """
+    return len(text) // 4 + 1
+
+@st.cache_resource(show_spinner=False)
+def load_embedding_model():
+    """
+    Load the sentence embedding model used for context compression.
+    The int8-quantized ONNX export is preferred; it falls back to the FP32 model when the
+    ONNX backend (sentence-transformers>=3.2 with onnxruntime) is unavailable.
+    Returns None when sentence-transformers is not installed or the model cannot be loaded,
+    which disables compression instead of failing the query.
+    """
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        return None
+    try:
+        return SentenceTransformer(
+            "sentence-transformers/all-MiniLM-L6-v2",
+            backend="onnx",
+            model_kwargs={"file_name": "onnx/model_qint8_avx512_vnni.onnx"}
+        )
+    except (ImportError, TypeError, ValueError, OSError):
+        # Missing optimum/onnxruntime, a version without the backend argument, or no ONNX export
+        pass
+    try:
+        return SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+    except Exception:
+        # e.g. offline or rate-limited model download; compression is optional
+        return None
+
+def _cosine_scores(embeddings: np.ndarray, query_embedding: np.ndarray) -> np.ndarray:
+    """
+    Cosine similarity of every row of an (N, d) embedding matrix with a query vector,
+    computed as a single matrix-vector product.
+    """
+    E = np.asarray(embeddings, dtype=np.float32)
+    q = np.asarray(query_embedding, dtype=np.float32)
+    return E @ q / (np.linalg.norm(E, axis=1) * np.linalg.norm(q) + 1e-9)
+
+def _split_sentences(chunk: str) -> Tuple[List[str], List[str]]:
+    """
+    Split a chunk into sentences and lines, returning the sentences together with the
+    whitespace separating each pair of neighbours so the layout can be restored.
+    """
+    pieces = re.split(r"((?<=[.!?])[ \t]+|[ \t]*\n\s*)", chunk.strip())
+    return pieces[0::2], pieces[1::2]
+
+def _compress_chunk(sentences: List[str], separators: List[str], scores: np.ndarray, token_cap: int) -> str:
+    """
+    Keep the sentences with the highest scores, in their original order,
+    up to roughly token_cap tokens. Kept sentences are rejoined with the strongest
+    separator between them, so paragraph breaks, list items and table rows survive.
+    """
+    keep = []
+    tokens = 0
+    for i in np.argsort(-scores, kind="stable"):
+        sentence_tokens = _estimate_tokens(sentences[i])
+        if keep and tokens + sentence_tokens > token_cap:
+            continue
+        keep.append(i)
+        tokens += sentence_tokens
+    
+    keep.sort()
+    parts = [sentences[keep[0]]]
+    for previous, current in zip(keep, keep[1:]):
+        parts.append(max(separators[previous:current], key=lambda sep: sep.count("\n")))
+        parts.append(sentences[current])
+    return "".join(parts)
+
+class TTLCache:
+    """
+    Small in-process LRU cache whose entries also expire after a fixed time-to-live.
+    Safe to share between threads.
+    """
+    def __init__(self, maxsize: int = 256, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Return the cached value for key, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Store value under key, evicting the least recently used entry when full.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+    
+    def clear(self) -> None:
+        """
+        Drop every cached entry.
+        """
+        with self._lock:
+            self._entries.clear()
 
 class RAGPipeline:
-    def __init__(self, ragie_api_key: str, anthropic_api_key: str, serpapi_api_key: Optional[str] = None):
+    def __init__(self, ragie_api_key: str, anthropic_api_key: str, serpapi_api_key: Optional[str] = None,
+                 top_k: int = 8, token_budget: int = 3000, chunk_token_cap: Optional[int] = 200):
         """
         Initialize the RAG pipeline with API keys.
+        top_k and token_budget bound how many retrieved chunks reach the prompt;
+        chunk_token_cap limits each chunk after compression (None disables compression).
         """
         self.ragie_api_key = ragie_api_key
         self.anthropic_api_key = anthropic_api_key
         self.serpapi_api_key = serpapi_api_key
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.chunk_token_cap = chunk_token_cap
         self.anthropic_client = Anthropic(api_key=anthropic_api_key)
         
+        # Caches for repeated queries within a session
+        self.chunk_cache = TTLCache(maxsize=256, ttl=600)
+        self.response_cache = TTLCache(maxsize=256, ttl=3600)
+        
         # API endpoints for document service
         self.RAGIE_UPLOAD_URL = "https://api.ragie.ai/documents/url"
         self.RAGIE_RETRIEVAL_URL = "https://api.ragie.ai/retrievals"
+        self.RAGIE_DOCUMENT_URL = "https://api.ragie.ai/documents/{document_id}"
+        self.SERPAPI_SEARCH_URL = "https://serpapi.com/search.json"
+        
+        # Ragie request headers are built once per pipeline
+        self._ragie_headers = {
+            "accept": "application/json",
+            "content-type": "application/json",
+            "authorization": f"Bearer {ragie_api_key}"
+        }
+        
+        # Persistent HTTP sessions so repeated calls reuse pooled keep-alive connections.
+        # SerpApi gets its own session so the Ragie token is never sent to it.
+        self._http = self._create_session()
+        self._http.headers.update(self._ragie_headers)
+        # Retrieval is a read, so its POST is retried too; the upload POST keeps the default policy
+        self._http.mount(self.RAGIE_RETRIEVAL_URL, self._create_adapter(Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"}
+        )))
+        self._search_http = self._create_session()
+        # Status polling backs off in its own loop, so its session does not retry underneath it
+        self._poll_http = self._create_session(max_retries=0)
+        self._poll_http.headers.update(self._ragie_headers)
+        
+        # Worker threads that run the blocking retrieval calls concurrently on the pooled sessions
+        self._executor = ThreadPoolExecutor(max_workers=8)
+    
+    @staticmethod
+    def _create_adapter(max_retries: Optional[Union[Retry, int]] = None) -> HTTPAdapter:
+        """
+        Create a pooled HTTP adapter that, by default, retries transient gateway errors.
+        """
+        if max_retries is None:
+            max_retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        return HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=10,
+            max_retries=max_retries
+        )
+    
+    @classmethod
+    def _create_session(cls, max_retries: Optional[Union[Retry, int]] = None) -> requests.Session:
+        """
+        Create a pooled requests session that, by default, retries transient gateway errors.
+        """
+        session = requests.Session()
+        session.mount("https://", cls._create_adapter(max_retries))
+        return session
     
     def upload_document(self, url: str, name: Optional[str] = None, mode: str = "fast") -> Dict:
         """
         Upload a document to Ragie from a URL.
         """
         if not name:
-            name = urlparse(url).path.split('/')[-1] or "document"
+            # Last segment of the URL, without fragment or query string
+            name = url.split('#', 1)[0].split('?', 1)[0].rsplit('/', 1)[-1] or "document"
             
         payload = {
             "mode": mode,
@@ -32,65 +258,140 @@ class RAGPipeline:
             "url": url
         }
         
-        headers = {
-            "accept": "application/json",
-            "content-type": "application/json",
-            "authorization": f"Bearer {self.ragie_api_key}"
-        }
-        
-        response = requests.post(self.RAGIE_UPLOAD_URL, json=payload, headers=headers, timeout=10)
+        response = self._http.post(self.RAGIE_UPLOAD_URL, data=orjson.dumps(payload), timeout=10)
         
         if not response.ok:
             raise Exception(f"Document upload failed: {response.status_code} {response.reason}")
+        
+        # Newly indexed content can change retrieval results
+        self.chunk_cache.clear()
+        return orjson.loads(response.content)
+    
+    def wait_until_ready(self, document_id: str, timeout: float = 60) -> Dict:
+        """
+        Poll Ragie until the document is indexed, backing off exponentially between checks.
+        """
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        status = None
+        while True:
+            # Each request is a single attempt bounded by the time left, so a poll cannot run past the deadline
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Document {document_id} was not ready after {timeout} seconds (status: {status})")
+            try:
+                response = self._poll_http.get(
+                    self.RAGIE_DOCUMENT_URL.format(document_id=document_id),
+                    timeout=min(10, remaining)
+                )
+            except requests.RequestException:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Document {document_id} was not ready after {timeout} seconds (status: {status})")
+                raise
+            # Transient gateway errors are retried by the backoff below rather than by the session
+            if response.status_code not in (502, 503, 504):
+                if not response.ok:
+                    raise Exception(f"Document status check failed: {response.status_code} {response.reason}")
+                
+                document = orjson.loads(response.content)
+                status = document.get("status")
+                if status in ("ready", "indexed"):
+                    # Results cached while the document was still indexing are stale
+                    self.chunk_cache.clear()
+                    return document
+                if status == "failed":
+                    raise Exception(f"Document indexing failed for {document_id}")
             
-        return response.json()
+            delay = min(0.25 * 2 ** attempt, 2.0)
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f"Document {document_id} was not ready after {timeout} seconds (status: {status})")
+            time.sleep(delay)
+            attempt += 1
     
-    def retrieve_chunks(self, query: str, scope: str = "tutorial") -> List[str]:
+    @staticmethod
+    def _retrieval_payload(query: str, scope: str) -> Dict:
         """
-        Retrieve relevant chunks from Ragie for a given query.
+        Build the payload for a Ragie retrieval request.
         """
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.ragie_api_key}"
-        }
-        
-        payload = {
+        return {
             "query": query,
             "filters": {
                 "scope": scope
             }
         }
+    
+    @staticmethod
+    def _iter_ranked_chunks(scored_chunks: List[Dict]) -> Iterator[str]:
+        """
+        Lazily yield chunk texts by descending score, skipping near-duplicates.
+        A heap means only the chunks actually consumed are ordered.
+        """
+        heap = [(-chunk.get("score", 0), i) for i, chunk in enumerate(scored_chunks)]
+        heapq.heapify(heap)
+        seen = set()
+        while heap:
+            text = scored_chunks[heapq.heappop(heap)[1]]["text"]
+            digest = hashlib.blake2b(re.sub(r"\s+", " ", text.lower()).strip().encode(), digest_size=16).digest()
+            if digest not in seen:
+                seen.add(digest)
+                yield text
+    
+    def _select_chunks(self, scored_chunks: List[Dict]) -> List[str]:
+        """
+        Keep the highest scoring chunks, skipping near-duplicates, until top_k chunks
+        are selected or the estimated token budget is spent.
+        """
+        selected = []
+        tokens = 0
+        for text in itertools.islice(self._iter_ranked_chunks(scored_chunks), self.top_k):
+            chunk_tokens = _estimate_tokens(text)
+            if selected and tokens + chunk_tokens > self.token_budget:
+                break
+            tokens += chunk_tokens
+            selected.append(text)
+        return selected
+    
+    def retrieve_chunks(self, query: str, scope: str = "tutorial") -> List[str]:
+        """
+        Retrieve relevant chunks from Ragie for a given query, trimmed to top_k and
+        compressed to chunk_token_cap.
+        """
+        cached = self.chunk_cache.get((_normalize_query(query), scope))
+        if cached is not None:
+            return cached
         
-        response = requests.post(
+        response = self._http.post(
             self.RAGIE_RETRIEVAL_URL,
-            headers=headers,
-            json=payload,
+            data=orjson.dumps(self._retrieval_payload(query, scope)),
             timeout=10
         )
         
         if not response.ok:
             raise Exception(f"Retrieval failed: {response.status_code} {response.reason}")
             
-        data = response.json()
-        return [chunk["text"] for chunk in data.get("scored_chunks", [])]
+        doc_chunks = self._select_chunks(orjson.loads(response.content).get("scored_chunks", []))
+        # Compressed here so the cache holds the final chunks and repeated queries skip the embedding step
+        if doc_chunks and self.chunk_token_cap:
+            doc_chunks = self.compress_chunks(doc_chunks, query)
+        self.chunk_cache.set((_normalize_query(query), scope), doc_chunks)
+        return doc_chunks
     
-    def retrieve_web_results(self, query: str, num_results: int = 3) -> List[str]:
+    def _search_params(self, query: str, num_results: int) -> Dict:
         """
-        Retrieve web search results from SerpApi based on the query.
+        Build the query parameters for a SerpApi search.
         """
-        if not self.serpapi_api_key:
-            return []
-        search_url = "https://serpapi.com/search.json"
-        params = {
+        return {
             "engine": "google",
             "q": query,
             "api_key": self.serpapi_api_key,
             "num": num_results
         }
-        response = requests.get(search_url, params=params, timeout=10)
-        if not response.ok:
-            raise Exception(f"Web search failed: {response.status_code} {response.reason}")
-        data = response.json()
+    
+    @staticmethod
+    def _format_web_results(data: Dict, num_results: int) -> List[str]:
+        """
+        Format SerpApi organic results as Markdown snippets.
+        """
         results = []
         if "organic_results" in data:
             for result in data["organic_results"][:num_results]:
@@ -98,35 +399,115 @@ class RAGPipeline:
                 snippet = result.get("snippet", "")
                 results.append(f"**{title}**: {snippet}")
         return results
+    
+    def retrieve_web_results(self, query: str, num_results: int = 3) -> List[str]:
+        """
+        Retrieve web search results from SerpApi based on the query.
+        """
+        if not self.serpapi_api_key:
+            return []
+        params = self._search_params(query, num_results)
+        response = self._search_http.get(self.SERPAPI_SEARCH_URL, params=params, timeout=10)
+        if not response.ok:
+            raise Exception(f"Web search failed: {response.status_code} {response.reason}")
+        return self._format_web_results(orjson.loads(response.content), num_results)
+    
+    def _retrieve_both(self, query: str, scope: str = "tutorial") -> Tuple[List[str], List[str]]:
+        """
+        Run the Ragie retrieval and the SerpApi search concurrently, collecting each
+        result as it completes. The web search is skipped entirely without a SerpApi
+        key, and a failure in either call is raised without waiting on the other.
+        """
+        futures = {self._executor.submit(self.retrieve_chunks, query, scope): "doc"}
+        if self.serpapi_api_key:
+            futures[self._executor.submit(self.retrieve_web_results, query)] = "web"
+        
+        results = {"doc": [], "web": []}
+        try:
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+        return results["doc"], results["web"]
 
-    def create_system_prompt(self, doc_chunks: List[str], web_results: List[str]) -> str:
+    def compress_chunks(self, doc_chunks: List[str], query: str) -> List[str]:
         """
-        Create the system prompt with the retrieved document chunks and web search results.
+        Drop the sentences of each chunk least related to the query so less text reaches the prompt.
         """
-        prompt_parts = []
-        if doc_chunks:
-            joined_doc_chunks = "\n\n".join(doc_chunks)
-            prompt_parts.append(f"Document Information:\n===\n{joined_doc_chunks}\n===")
-        if web_results:
-            joined_web_results = "\n\n".join(web_results)
-            prompt_parts.append(f"Web Search Results:\n===\n{joined_web_results}\n===")
+        model = load_embedding_model()
+        if model is None:
+            return doc_chunks
         
-        context_info = "\n\n".join(prompt_parts)
+        # Only chunks over the cap are compressed; their sentences are embedded and scored in one batch
+        split = {
+            i: _split_sentences(chunk)
+            for i, chunk in enumerate(doc_chunks)
+            if _estimate_tokens(chunk) > self.chunk_token_cap
+        }
+        if not split:
+            return doc_chunks
+        sentences = [sentence for chunk_sentences, _ in split.values() for sentence in chunk_sentences]
+        embeddings = model.encode([query] + sentences, convert_to_numpy=True)
+        scores = _cosine_scores(embeddings[1:], embeddings[0])
         
-        return f"""These are very important instructions: You are "Ragie AI", a professional but friendly AI chatbot assisting the user. Your task is to answer the user based on the information provided below. Answer informally, directly, and concisely, including all relevant details. Use Markdown for formatting (e.g., **bold**, *italic*, lists, etc.) and $$ for LaTeX where appropriate. Organize your answer into sections if needed. Do not include raw IDs or sensitive information.
+        compressed = list(doc_chunks)
+        offset = 0
+        for i, (chunk_sentences, separators) in split.items():
+            chunk_scores = scores[offset:offset + len(chunk_sentences)]
+            compressed[i] = _compress_chunk(chunk_sentences, separators, chunk_scores, self.chunk_token_cap)
+            offset += len(chunk_sentences)
+        return compressed
 
-Here is the context available for you:
-{context_info}
+    def create_system_prompt(self, doc_chunks: List[str], web_results: List[str]) -> List[Dict]:
+        """
+        Create the system prompt with the retrieved document chunks and web search results.
+        The static instructions come first and are marked for prompt caching; the
+        retrieved context follows in a separate block so it never breaks the cached prefix.
+        """
+        parts = [CONTEXT_HEADER]
+        for title, items in (("Document Information", doc_chunks), ("Web Search Results", web_results)):
+            if not items:
+                continue
+            if len(parts) > 1:
+                parts.append("\n\n")
+            parts += [title, ":\n===\n", "\n\n".join(items), "\n==="]
+        parts.append(CONTEXT_FOOTER)
+        
+        return [STATIC_INSTRUCTIONS_BLOCK, {"type": "text", "text": "".join(parts)}]
 
-If the context is missing or insufficient, please indicate that the available information might be incomplete. END SYSTEM INSTRUCTIONS"""
+    @staticmethod
+    def _response_cache_key(system_prompt: List[Dict], query: str) -> str:
+        """
+        Hash a system prompt and query into a response cache key.
+        The model and token limit are part of the key so changing either invalidates old answers.
+        """
+        hasher = hashlib.sha256()
+        for block in system_prompt:
+            hasher.update(block["text"].encode())
+        # A plain string key is stored by diskcache as-is rather than pickled
+        query_hash = hashlib.sha256(_normalize_query(query).encode()).hexdigest()
+        return f"{ANTHROPIC_MODEL}:{MAX_RESPONSE_TOKENS}:{hasher.hexdigest()}:{query_hash}"
 
-    def generate_response(self, system_prompt: str, query: str) -> str:
+    def stream_response(self, system_prompt: List[Dict], query: str) -> Iterator[str]:
         """
-        Generate a response using Anthropic's language model.
+        Stream a response from Anthropic's language model, yielding text as it arrives.
+        Identical prompt/query pairs are answered from the in-process cache, then the on-disk cache.
         """
-        message = self.anthropic_client.messages.create(
-            model="claude-3-sonnet-20240229",
-            max_tokens=1024,
+        cache_key = self._response_cache_key(system_prompt, query)
+        cached = self.response_cache.get(cache_key)
+        if cached is None:
+            cached = get_response_disk_cache().get(cache_key)
+            if cached is not None:
+                self.response_cache.set(cache_key, cached)
+        if cached is not None:
+            yield cached
+            return
+        
+        parts = []
+        with self.anthropic_client.messages.stream(
+            model=ANTHROPIC_MODEL,
+            max_tokens=MAX_RESPONSE_TOKENS,
             system=system_prompt,
             messages=[
                 {
@@ -134,21 +515,82 @@ If the context is missing or insufficient, please indicate that the available in
                     "content": query
                 }
             ]
-        )
-        return message.content[0].text if message.content and isinstance(message.content, list) else message.content
+        ) as stream:
+            for text in stream.text_stream:
+                parts.append(text)
+                yield text
+        response = "".join(parts)
+        self.response_cache.set(cache_key, response)
+        get_response_disk_cache().set(cache_key, response, expire=24 * 3600)
+
+    def generate_response(self, system_prompt: List[Dict], query: str) -> str:
+        """
+        Generate a response using Anthropic's language model.
+        """
+        return "".join(self.stream_response(system_prompt, query))
+
+    def _answer_stream(self, query: str, doc_chunks: List[str], web_results: List[str]) -> Iterator[str]:
+        """
+        Stream the final answer for a query from its retrieved context.
+        """
+        if not doc_chunks and not web_results:
+            yield "No relevant information found for your query."
+            return
+        
+        system_prompt = self.create_system_prompt(doc_chunks, web_results)
+        yield from self.stream_response(system_prompt, query)
+
+    def _answer(self, query: str, doc_chunks: List[str], web_results: List[str]) -> str:
+        """
+        Generate the final answer for a query from its retrieved context.
+        """
+        return "".join(self._answer_stream(query, doc_chunks, web_results))
 
     def process_query(self, query: str, scope: str = "tutorial") -> str:
         """
         Process a query through the complete RAG pipeline, using both document chunks and web search results.
+        Returns without calling Anthropic when nothing was retrieved.
+        """
+        doc_chunks, web_results = self._retrieve_both(query, scope)
+        return self._answer(query, doc_chunks, web_results)
+
+    def process_query_stream(self, query: str, scope: str = "tutorial") -> Iterator[str]:
+        """
+        Like process_query, but yields the response text incrementally as it is generated.
+        """
+        doc_chunks, web_results = self._retrieve_both(query, scope)
+        yield from self._answer_stream(query, doc_chunks, web_results)
+
+    def process_queries(self, queries: List[str], scope: str = "tutorial", max_concurrency: int = 8) -> List[Union[str, Exception]]:
         """
-        doc_chunks = self.retrieve_chunks(query, scope)
-        web_results = self.retrieve_web_results(query) if self.serpapi_api_key else []
+        Process several queries at once: all retrievals run concurrently, then the
+        Anthropic calls are fanned out with at most max_concurrency in flight.
+        Results are returned in the same order as queries; a query that fails gets its
+        exception in its slot instead of failing the whole batch.
+        """
+        doc_futures = [self._executor.submit(self.retrieve_chunks, query, scope) for query in queries]
+        web_futures = [self._executor.submit(self.retrieve_web_results, query) for query in queries]
         
-        if not doc_chunks and not web_results:
-            return "No relevant information found for your query."
+        def answer(query: str, doc_future: Future, web_future: Future) -> str:
+            return self._answer(query, doc_future.result(), web_future.result())
         
-        system_prompt = self.create_system_prompt(doc_chunks, web_results)
-        return self.generate_response(system_prompt, query)
+        results = []
+        with ThreadPoolExecutor(max_workers=max_concurrency) as answer_executor:
+            answer_futures = [
+                answer_executor.submit(answer, query, doc_future, web_future)
+                for query, doc_future, web_future in zip(queries, doc_futures, web_futures)
+            ]
+            for future in answer_futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(e)
+        return results
+
+@st.cache_resource(show_spinner=False)
+def get_pipeline(ragie_api_key: str, anthropic_api_key: str, serpapi_api_key: Optional[str] = None) -> RAGPipeline:
+    """Create one shared pipeline per distinct set of API keys, reused across reruns."""
+    return RAGPipeline(ragie_api_key, anthropic_api_key, serpapi_api_key)
 
 def initialize_session_state():
     """Initialize session state variables."""
@@ -212,7 +654,7 @@ def main():
             if submit_api:
                 if ragie_key and anthropic_key:
                     try:
-                        st.session_state.pipeline = RAGPipeline(ragie_key, anthropic_key, serpapi_key)
+                        st.session_state.pipeline = get_pipeline(ragie_key, anthropic_key, serpapi_key)
                         st.session_state.api_keys_submitted = True
                         st.success("API keys configured successfully!")
                     except Exception as e:
@@ -236,13 +678,14 @@ def main():
                     if doc_url:
                         try:
                             with st.spinner("Uploading document..."):
-                                st.session_state.pipeline.upload_document(
+                                document = st.session_state.pipeline.upload_document(
                                     url=doc_url,
                                     name=doc_name if doc_name else None,
                                     mode=upload_mode
                                 )
-                                # Replace time.sleep with a proper polling mechanism if possible.
-                                time.sleep(5)  # Simulate waiting for indexing.
+                                if "id" not in document:
+                                    raise Exception("Ragie did not return a document id for the upload.")
+                                st.session_state.pipeline.wait_until_ready(document["id"])
                                 st.session_state.document_uploaded = True
                                 st.success("Document uploaded and indexed successfully!")
                         except Exception as e:
@@ -264,9 +707,12 @@ def main():
                     if query:
                         try:
                             with st.spinner("Generating response..."):
-                                response = st.session_state.pipeline.process_query(query)
                                 st.markdown("### Response:")
-                                st.markdown(response)
+                                placeholder = st.empty()
+                                response = ""
+                                for chunk in st.session_state.pipeline.process_query_stream(query):
+                                    response += chunk
+                                    placeholder.markdown(response)
                         except Exception as e:
                             st.error(f"Error generating response: {str(e)}")
                     else: